@@ -1,16 +1,24 @@
 # app.py
+import hashlib
 import io
+import os
+import random
+import shutil
+import threading
+import time
 import uuid
-import base64
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 
 import streamlit as st
 import streamlit.components.v1 as components
 
-import gspread
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from PIL import Image, ImageOps
+
+# gspread / google-auth / googleapiclient はimportだけで数百msかかるため
+# トップレベルでは読み込まず、実際にAPIへアクセスする関数の中でimportする。
+# 初回アクセス以降はsys.modulesヒットになるのでコストはかからない
 
 
 # =========================
@@ -21,46 +29,59 @@ SCOPES = [
     "https://www.googleapis.com/auth/spreadsheets",
 ]
 
+# 選択肢系の定数はrerunのたびに再束縛されるので、不変なtupleで持つ
+# （ウィジェット側で誤って破壊的変更される事故も防げる）
+
 # ★IDEAL追加
-REQUIRED_IMAGE_TYPES = ["ロゴ", "馬車タグ", "製造国タグ", "YKK", "IDEAL"]
+REQUIRED_IMAGE_TYPES = ("ロゴ", "馬車タグ", "製造国タグ", "YKK", "IDEAL")
 
-LEARN_NO_REASONS = [
+LEARN_NO_REASONS = (
     "画像品質不良（ピント/反射/暗い）",
     "必要情報が写っていない",
     "基準未確定／判断が割れる",
     "テスト・検証用データ",
     "その他（自由記述で補足）",
-]
+)
 
 REASONS_BY_TYPE = {
-    "ロゴ": [
+    "ロゴ": (
         "ロゴ：フォント／配置／刻印が基準内",
         "ロゴ：にじみ／ズレ／形状違い",
-    ],
-    "馬車タグ": [
+    ),
+    "馬車タグ": (
         "馬車タグ：ピッチが5/7で基準内",
         "馬車タグ：ピッチが基準外（5/7以外）",
         "馬車タグ：キャビン形状が基準内",
         "馬車タグ：キャビン形状が基準外",
-    ],
-    "製造国タグ": [
+    ),
+    "製造国タグ": (
         "製造国タグ：印刷／フォントが自然",
         "製造国タグ：にじみ／ズレ／フォント異常",
-    ],
-    "YKK": [
+    ),
+    "YKK": (
         "YKK：刻印が深く均一",
         "YKK：刻印が浅い／欠け／潰れ",
-    ],
+    ),
     # IDEALは基準未確定のため、選択肢理由は出さない（disabledで対応）
 }
 COMMON_REASON_ALWAYS = "判別不可（画像不鮮明）"
 
+OVERALL_REASON_CHOICES = (
+    "馬車タグが基準内のため総合は基準内寄り",
+    "最重要ポイント（馬車タグ）が基準外のため総合は基準外寄り",
+    "情報不足のため総合判断つかず",
+    "複合的に判断（基準内要素が優勢）",
+    "複合的に判断（基準外要素が優勢）",
+)
+
 THUMB_WIDTH_PX = 280
 ZOOM_HEIGHT_PX = 650
 
-
-def now_str() -> str:
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# これ以上のサイズはresumableアップロードに切り替える（小さいファイルは1発のほうが速い）
+RESUMABLE_THRESHOLD_BYTES = 5 * 1024 * 1024
+# チャンクが大きいほどチャンク境界の往復が減りスループットが出る
+# （8MBなら典型的なスマホ写真は1〜2チャンクで送り切れる）
+UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024
 
 
 def init_state():
@@ -74,52 +95,132 @@ def init_state():
     st.session_state.setdefault("judge_person_keep", "")
 
 
-def get_clients():
+@st.cache_resource(show_spinner=False)
+def get_credentials():
+    from google.oauth2.service_account import Credentials
+
     sa_info = dict(st.secrets["gcp_service_account"])
-    creds = Credentials.from_service_account_info(sa_info, scopes=SCOPES)
-    gc = gspread.authorize(creds)
-    drive = build("drive", "v3", credentials=creds)
-    return gc, drive
-
-
-def ensure_folder(drive, name: str, parent_id: str) -> str:
-    q = (
-        "mimeType='application/vnd.google-apps.folder' and "
-        f"name='{name}' and "
-        f"'{parent_id}' in parents and "
-        "trashed=false"
-    )
+    return Credentials.from_service_account_info(sa_info, scopes=SCOPES)
 
-    res = drive.files().list(
-        q=q,
-        fields="files(id,name)",
-        includeItemsFromAllDrives=True,
-        supportsAllDrives=True,
-    ).execute()
 
-    files = res.get("files", [])
-    if files:
-        return files[0]["id"]
+@st.cache_resource(show_spinner=False)
+def get_gspread():
+    # 認証情報のパースは毎rerunだと数百msかかるため、
+    # プロセス内で1回だけ生成して使い回す（返り値は変更しないこと）。
+    # Driveクライアントはアップロードのワーカースレッドごとに持つ（thread_drive参照）
+    import gspread
+
+    return gspread.authorize(get_credentials())
+
+
+# 一時的なレート制限／サーバエラー。これ以外（権限・不正リクエスト等）は即座に上げる
+_RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+def _retry(fn, *args, _tries=5, **kwargs):
+    # Drive/Sheetsの一時的な429/5xxを指数バックオフ＋ジッタで再試行する。
+    # これがないと1回の429で保存全体がユーザーのやり直しになる
+    from googleapiclient.errors import HttpError
+    from gspread.exceptions import APIError
+
+    for attempt in range(_tries):
+        try:
+            return fn(*args, **kwargs)
+        except HttpError as e:
+            if e.resp.status not in _RETRYABLE_STATUSES or attempt == _tries - 1:
+                raise
+        except APIError as e:
+            if e.response.status_code not in _RETRYABLE_STATUSES or attempt == _tries - 1:
+                raise
+        time.sleep(min(2 ** attempt, 16) + random.random())
+
+
+_drive_tls = threading.local()
+
+
+def thread_drive(creds):
+    # httplib2ベースのDriveクライアントはスレッドセーフではないので、
+    # アップロードのワーカースレッドごとに専用クライアントを1つ持たせる。
+    # executorのスレッドは使い回されるため、接続も温まったまま維持される
+    drive = getattr(_drive_tls, "drive", None)
+    if drive is None:
+        import google_auth_httplib2
+        import httplib2
+        from googleapiclient.discovery import build
+
+        # static_discovery=True：ライブラリ同梱のdiscovery定義を使い、
+        # 初回のHTTPS往復（discovery JSONの取得＋パース）を省く
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+        drive = build("drive", "v3", http=http, cache_discovery=False, static_discovery=True)
+        _drive_tls.drive = drive
+    return drive
+
 
+def create_folder(drive, name: str, parent_id: str) -> str:
+    # ケースフォルダ名はuuid入りのcase_idで毎回ユニークなので、
+    # 既存チェックのfiles.listは行わず無条件に作成する。
+    # 保存側のバックグラウンドスレッドから呼ばれるため、
+    # ここでst.session_stateに触ってはいけない（_do_save参照）
     metadata = {"name": name, "mimeType": "application/vnd.google-apps.folder", "parents": [parent_id]}
-    folder = drive.files().create(body=metadata, fields="id", supportsAllDrives=True).execute()
+    folder = _retry(drive.files().create(body=metadata, fields="id", supportsAllDrives=True).execute)
     return folder["id"]
 
 
-def upload_image_to_drive(drive, parent_folder_id: str, filename: str, data: bytes, mimetype: str):
-    media = MediaIoBaseUpload(io.BytesIO(data), mimetype=mimetype, resumable=False)
+def upload_image_to_drive(drive, parent_folder_id: str, filename: str, fileobj, mimetype: str):
+    # fileobjはシーク可能なファイルライクオブジェクト（UploadedFileをそのまま渡せる）。
+    # bytesを取り出してBytesIOに包み直すと数MBのコピーが2回走るので、バッファから直接送る
+    from googleapiclient.http import MediaIoBaseUpload
+
     file_metadata = {"name": filename, "parents": [parent_folder_id]}
-    f = drive.files().create(
+
+    fileobj.seek(0, io.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+
+    if size < RESUMABLE_THRESHOLD_BYTES:
+        media = MediaIoBaseUpload(fileobj, mimetype=mimetype, resumable=False)
+        f = _retry(
+            drive.files().create(
+                body=file_metadata,
+                media_body=media,
+                fields="id, webViewLink",
+                supportsAllDrives=True,
+            ).execute
+        )
+        return f["id"], f.get("webViewLink", "")
+
+    # 大きい写真はチャンク分割のresumableで送る。
+    # 通信が切れてもチャンク単位で再送できる（resumable=Falseだと全量やり直し）
+    media = MediaIoBaseUpload(
+        fileobj, mimetype=mimetype, chunksize=UPLOAD_CHUNK_BYTES, resumable=True
+    )
+    req = drive.files().create(
         body=file_metadata,
         media_body=media,
         fields="id, webViewLink",
         supportsAllDrives=True,
-    ).execute()
-    return f["id"], f.get("webViewLink", "")
+    )
+    resp = None
+    while resp is None:
+        _status, resp = req.next_chunk(num_retries=3)
+    return resp["id"], resp.get("webViewLink", "")
+
+
+@st.cache_resource(show_spinner=False)
+def upload_executor() -> ThreadPoolExecutor:
+    # 保存のたびにプールを作って壊すのではなく、プロセスで1つを使い回す
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="drive-upload")
+
+
+@st.cache_resource(show_spinner=False)
+def save_executor() -> ThreadPoolExecutor:
+    # ケース保存ジョブ（_do_save）用。upload_executorと同じくプロセスで1つを使い回す
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="case-save")
 
 
-def open_worksheets(gc, spreadsheet_id: str):
-    sh = gc.open_by_key(spreadsheet_id)
+def _ensure_schema(sh):
+    # Cases/Imagesタブの存在確認と作成。worksheets()の全タブ一覧も
+    # Sheetsへの1往復なので、キャッシュミス時（＝初回）だけ呼ぶこと
     titles = [ws.title for ws in sh.worksheets()]
 
     if "Cases" not in titles:
@@ -138,16 +239,150 @@ def open_worksheets(gc, spreadsheet_id: str):
             "learn_yn", "learn_no_reason", "created_at"
         ])
 
-    return sh.worksheet("Cases"), sh.worksheet("Images")
+
+@st.cache_resource(ttl="1h", show_spinner=False)
+def open_worksheets(spreadsheet_id: str):
+    # open_by_key＋worksheet()はそれぞれSheetsへのHTTP呼び出し。
+    # シート構成はセッション中に消えないので、spreadsheet_idごとにキャッシュする
+    sh = get_gspread().open_by_key(spreadsheet_id)
+    _ensure_schema(sh)
+    return sh, sh.worksheet("Cases"), sh.worksheet("Images")
+
+
+def _append_cells_request(sheet_id: int, rows):
+    # spreadsheets.batchUpdateのappendCellsリクエストを組み立てる。
+    # 複数シートへの追記を1回のHTTP往復にまとめるために使う。
+    def _cell(v):
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            return {"userEnteredValue": {"numberValue": v}}
+        return {"userEnteredValue": {"stringValue": v if isinstance(v, str) else str(v)}}
+
+    return {
+        "appendCells": {
+            "sheetId": sheet_id,
+            "rows": [{"values": [_cell(v) for v in row]} for row in rows],
+            "fields": "userEnteredValue",
+        }
+    }
+
+
+def _do_save(
+    creds,
+    executor,
+    upload_cache,
+    drive_root_folder_id,
+    case_id,
+    created_at,
+    images_payload,
+    sh,
+    images_sheet_id,
+    cases_sheet_id,
+    case_row,
+):
+    # 保存の重い部分（Driveアップロード＋Sheets追記）。バックグラウンドスレッドで
+    # 実行されるため、ここではStreamlit API（st.*）に一切触らないこと。
+    # 引数はすべてプレーンなデータか、スクリプトスレッド側で解決済みの
+    # クライアント/ハンドルを渡す
+    drive = thread_drive(creds)
+    case_folder_id = create_folder(drive, case_id, drive_root_folder_id)
+
+    def _upload_one(p):
+        content_key = hashlib.sha256(p["bytes"]).hexdigest()
+        hit = upload_cache.get(content_key)
+        if hit is not None:
+            return hit
+        filename = f"{p['image_type']}_{p['filename']}"
+        # BytesIOはbytesを書き換えない限りバッファを共有するのでコピーは発生しない
+        result = upload_image_to_drive(
+            thread_drive(creds), case_folder_id, filename, io.BytesIO(p["bytes"]), p["mimetype"]
+        )
+        upload_cache[content_key] = result
+        return result
+
+    # DriveアップロードはI/O待ちが支配的なので並列化する
+    # （4並列ならDriveのper-userレート制限には余裕で収まる）
+    results = list(executor.map(_upload_one, images_payload))
+
+    image_rows = [
+        [
+            case_id, p["image_type"], file_id, view_url,
+            p["judge"], p["reason_choices"], p["reason_free"],
+            p["learn_yn"], p["learn_no_reason"], created_at
+        ]
+        for p, (file_id, view_url) in zip(images_payload, results)
+    ]
+
+    # Images＋Casesの追記を1回のspreadsheets.batchUpdateにまとめる
+    _retry(sh.batch_update, {
+        "requests": [
+            _append_cells_request(images_sheet_id, image_rows),
+            _append_cells_request(cases_sheet_id, [case_row]),
+        ]
+    })
 
 
-def reason_options(image_type: str):
+@lru_cache(maxsize=8)
+def reason_options(image_type: str) -> tuple:
+    # 画像タイプは高々数種類の純関数なのでlru_cacheで十分。
+    # 返り値のidentityが安定するのでウィジェット側の差分判定も短絡できる
     # IDEALは基準未確定なので「選択肢を出さない」ためここは通常通り返しても使わない
-    return REASONS_BY_TYPE.get(image_type, []) + [COMMON_REASON_ALWAYS]
+    return REASONS_BY_TYPE.get(image_type, ()) + (COMMON_REASON_ALWAYS,)
+
+
+ZOOM_STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "zoom")
+
+
+@st.cache_resource(show_spinner=False)
+def purge_zoom_static() -> bool:
+    # 前回起動時に書き出した拡大ビューア画像を起動時に一掃する。
+    # 内容ハッシュ名で積み上がる一方なので、放置するとディスクを食い続ける
+    shutil.rmtree(ZOOM_STATIC_DIR, ignore_errors=True)
+    return True
+
+
+def zoom_image_url(image_bytes: bytes, mimetype: str) -> str:
+    # base64でHTMLに埋め込むと約33%膨らんだペイロードがrerunのたびに
+    # websocketを流れる。静的配信ディレクトリへ内容ハッシュ名で1回だけ
+    # 書き出し、以降はURL参照にする（server.enableStaticServingが必要）。
+    # 相対URLにしておくとbaseUrlPath配下にデプロイしても壊れない
+    ext = "png" if mimetype == "image/png" else "jpg"
+    name = f"{hashlib.sha256(image_bytes).hexdigest()[:16]}.{ext}"
+    path = os.path.join(ZOOM_STATIC_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(ZOOM_STATIC_DIR, exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(image_bytes)
+    # 次のアイテムへ進むとき削除できるよう、このセッションで使ったパスを控えておく
+    st.session_state.setdefault("_zoom_files", set()).add(path)
+    return f"app/static/zoom/{name}"
+
+
+def uploaded_bytes(uploaded) -> bytes:
+    # UploadedFile.getvalue()は呼ぶたびにバッファ全体のコピーを返す。
+    # file_id（同じアップロードの間は安定）をキーに1回だけ読み出して使い回す
+    cache = st.session_state.setdefault("_upload_bytes", {})
+    if uploaded.file_id not in cache:
+        cache[uploaded.file_id] = uploaded.getvalue()
+    return cache[uploaded.file_id]
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def thumb_bytes(data: bytes, w: int = THUMB_WIDTH_PX) -> bytes:
+    # スマホ写真（3〜10MB）をそのままst.imageに渡すとrerunごとに
+    # フルサイズのバイト列がフロントエンドへ流れる。表示幅280pxのサムネには
+    # 表示幅の2倍（高DPI端末向け）で十分なので、そこまで縮小したJPEGを
+    # 1回だけ作ってキャッシュする（数MB→数十KB）。
+    # 拡大ビューアとアップロード（Drive保存）には元のバイト列をそのまま使うこと。
+    im = Image.open(io.BytesIO(data))
+    im = ImageOps.exif_transpose(im)
+    im.thumbnail((w * 2, w * 8))
+    buf = io.BytesIO()
+    im.convert("RGB").save(buf, "JPEG", quality=82, optimize=True)
+    return buf.getvalue()
 
 
 def zoom_viewer(image_bytes: bytes, mimetype: str, height: int = 650):
-    b64 = base64.b64encode(image_bytes).decode("utf-8")
+    src = zoom_image_url(image_bytes, mimetype)
     html = r"""
 <div style="font-family: sans-serif;">
   <div style="display:flex; gap:8px; align-items:center; margin-bottom:8px;">
@@ -158,7 +393,7 @@ def zoom_viewer(image_bytes: bytes, mimetype: str, height: int = 650):
   </div>
 
   <div id="wrap" style="width:100%; height:__H__px; overflow:hidden; border-radius:12px; border:1px solid rgba(255,255,255,0.15); background:rgba(0,0,0,0.25); position:relative;">
-    <img id="img" src="data:__MIME__;base64,__B64__" style="transform-origin: 0 0; cursor:grab; user-select:none; -webkit-user-drag:none; position:absolute; left:0; top:0;" />
+    <img id="img" src="__SRC__" style="transform-origin: 0 0; cursor:grab; user-select:none; -webkit-user-drag:none; position:absolute; left:0; top:0;" />
   </div>
 </div>
 
@@ -196,7 +431,7 @@ def zoom_viewer(image_bytes: bytes, mimetype: str, height: int = 650):
   reset();
 </script>
 """
-    html = html.replace("__B64__", b64).replace("__MIME__", mimetype).replace("__H__", str(height))
+    html = html.replace("__SRC__", src).replace("__H__", str(height))
     components.html(html, height=height + 90, scrolling=False)
 
 
@@ -215,6 +450,17 @@ def scroll_to_title():
 def next_item_keep_judge_person(current_judge: str):
     st.session_state["judge_person_keep"] = current_judge
 
+    # フォームを進めると前のアップロードは参照されないので、バイト列キャッシュも捨てる
+    st.session_state.pop("_upload_bytes", None)
+
+    # 拡大ビューア用に書き出した画像も削除する。たまたま他セッションが同じ写真を
+    # 表示中でも、zoom_image_urlが次の描画で書き直すので消してよい
+    for path in st.session_state.pop("_zoom_files", ()):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
     st.session_state["form_id"] = st.session_state.get("form_id", 0) + 1
     st.session_state["saved"] = False
     st.session_state["last_case_id"] = ""
@@ -227,6 +473,7 @@ def next_item_keep_judge_person(current_judge: str):
 # UI
 # =========================
 init_state()
+purge_zoom_static()
 
 st.set_page_config(page_title="COACH 育成中専用画面", layout="wide")
 
@@ -260,71 +507,75 @@ st.divider()
 st.subheader("写真（1〜4枚）")
 st.caption("※ 画像タイプは必須、同一タイプは1枚まで。最初は1枚だけでも保存できます。")
 
-img_count = st.number_input("登録する写真枚数", min_value=1, max_value=4, value=1, step=1, key=f"{form_id}_img_count")
+# アップローダーを写真ごとに4つ並べると、Streamlitがrerunのたびに
+# 4ウィジェット分の状態をハッシュ・差分比較する。1つのmultiple-filesに集約する
+uploaded_files = st.file_uploader(
+    "画像アップロード（最大4枚・まとめて選択OK）",
+    type=["jpg", "jpeg", "png"],
+    accept_multiple_files=True,
+    key=f"{form_id}_uploads",
+)
+if len(uploaded_files) > 4:
+    st.warning("写真は最大4枚までです。先頭の4枚だけを使用します。")
+    uploaded_files = uploaded_files[:4]
+img_count = len(uploaded_files)
+
+def set_viewer(key: str, open_: bool):
+    # ビューア開閉はon_clickでstateだけ書き換える。
+    # 「if st.button(): state更新; st.rerun()」だとボタン押下のrerunに加えて
+    # 明示rerunがもう1周走り、画像描画が二重に実行されてしまう
+    st.session_state[key] = open_
 
-viewer_key = f"{form_id}_viewer_idx"
-st.session_state.setdefault(viewer_key, None)
-
-chosen_types = []
 images_payload = []
 
-for i in range(int(img_count)):
-    st.markdown(f"### 写真 {i+1}")
-    c1, c2, c3, c4 = st.columns([2, 1, 1, 1])
+# 写真1ブロック＝1フラグメント。ブロック内の操作（理由入力・ビューア開閉など）では
+# そのブロックだけが再実行され、他の写真のプレビュー/エンコードは走らない。
+#
+# タイプの選択肢は常に全タイプ（REQUIRED_IMAGE_TYPES）を出す。
+# 兄弟ブロックの選択で候補を絞ると、フラグメント再実行中は候補が更新されず、
+# さらにフルrerun時にoptionsが変わったselectboxが黙って先頭値へリセットされ、
+# 判定士が選んでいないタイプが記録されてしまう。
+# 重複とIDEAL/YKK排他は保存時のバリデーションで確実に弾く。
+@st.fragment
+def render_image_block(i: int, uploaded):
+    # ウィジェットキーの共通プレフィックスはブロックごとに1回だけ組み立てる
+    # （rerunのたびにf-stringを8個作らない）
+    kp = f"{form_id}_{i}_"
+
+    st.markdown(f"### 写真 {i+1}：{uploaded.name}")
+    c1, c2, c3 = st.columns(3)
 
     with c1:
-        uploaded = st.file_uploader(
-            f"画像アップロード（写真{i+1}）",
-            type=["jpg", "jpeg", "png"],
-            key=f"{form_id}_up_{i}"
-        )
+        image_type = st.selectbox("画像タイプ（必須）", options=REQUIRED_IMAGE_TYPES, key=kp + "type")
 
-    # ★双方向排他：IDEALとYKKは共存しない
-    # - IDEALが既に選ばれていたら、以降はYKKを候補から消す
-    # - YKKが既に選ばれていたら、以降はIDEALを候補から消す
     with c2:
-        available = [t for t in REQUIRED_IMAGE_TYPES if t not in chosen_types]
-        if "IDEAL" in chosen_types and "YKK" in available:
-            available.remove("YKK")
-        if "YKK" in chosen_types and "IDEAL" in available:
-            available.remove("IDEAL")
-
-        # 念のため：候補が空になった場合の保険（通常は起きない）
-        if not available:
-            available = [t for t in REQUIRED_IMAGE_TYPES if t not in chosen_types]
-
-        image_type = st.selectbox("画像タイプ（必須）", options=available, key=f"{form_id}_type_{i}")
-        chosen_types.append(image_type)
+        judge = st.selectbox("判定（必須）", ["基準内", "基準外", "判断つかず"], key=kp + "judge")
 
     with c3:
-        judge = st.selectbox("判定（必須）", ["基準内", "基準外", "判断つかず"], key=f"{form_id}_judge_{i}")
-
-    with c4:
-        learn_yn = st.radio("学習（必須）", ["Yes", "No"], horizontal=True, key=f"{form_id}_learn_{i}")
-
-    if uploaded is not None:
-        file_bytes = uploaded.getvalue()
-        mimetype = uploaded.type or "image/jpeg"
-
-        if st.session_state[viewer_key] == i:
-            topbar1, topbar2 = st.columns([1, 6])
-            with topbar1:
-                if st.button("× 閉じる（サムネへ戻る）", key=f"{form_id}_close_{i}"):
-                    st.session_state[viewer_key] = None
-                    st.rerun()
-            with topbar2:
-                st.markdown(f"**拡大表示：{image_type}**（横幅いっぱい）")
-            zoom_viewer(file_bytes, mimetype=mimetype, height=ZOOM_HEIGHT_PX)
-        else:
-            left, right = st.columns([1, 3])
-            with left:
-                st.markdown("**サムネ**")
-                st.image(file_bytes, width=THUMB_WIDTH_PX, caption=f"{image_type}")
-                if st.button("サムネを拡大表示", key=f"{form_id}_open_{i}"):
-                    st.session_state[viewer_key] = i
-                    st.rerun()
-            with right:
-                st.caption("拡大したい場合は「サムネを拡大表示」を押してください。")
+        learn_yn = st.radio("学習（必須）", ["Yes", "No"], horizontal=True, key=kp + "learn")
+
+    file_bytes = uploaded_bytes(uploaded)
+    mimetype = uploaded.type or "image/jpeg"
+
+    # 開閉フラグはブロックごとに持つ。全写真で共有の「開いているindex」を使うと、
+    # フラグメント化で開閉のrerunがそのブロックに閉じるため、他ブロックの表示が
+    # 古いindexのまま残る（ビューアが2つ開く／閉じても戻らない）
+    viewer_key = kp + "viewer"
+    if st.session_state.get(viewer_key):
+        topbar1, topbar2 = st.columns([1, 6])
+        with topbar1:
+            st.button("× 閉じる（サムネへ戻る）", key=kp + "close", on_click=set_viewer, args=(viewer_key, False))
+        with topbar2:
+            st.markdown(f"**拡大表示：{image_type}**（横幅いっぱい）")
+        zoom_viewer(file_bytes, mimetype=mimetype, height=ZOOM_HEIGHT_PX)
+    else:
+        left, right = st.columns([1, 3])
+        with left:
+            st.markdown("**サムネ**")
+            st.image(thumb_bytes(file_bytes), width=THUMB_WIDTH_PX, caption=f"{image_type}")
+            st.button("サムネを拡大表示", key=kp + "open", on_click=set_viewer, args=(viewer_key, True))
+        with right:
+            st.caption("拡大したい場合は「サムネを拡大表示」を押してください。")
 
     # ★IDEALのとき：判定理由（選択肢）は選択不可
     if image_type == "IDEAL":
@@ -332,7 +583,7 @@ for i in range(int(img_count)):
         reason_choices = st.multiselect(
             "判定理由（選択肢・複数OK）",
             options=[],
-            key=f"{form_id}_choices_{i}",
+            key=kp + "choices",
             disabled=True,
         )
         reason_choices_joined = ""
@@ -340,121 +591,180 @@ for i in range(int(img_count)):
         reason_choices = st.multiselect(
             "判定理由（選択肢・複数OK）",
             options=reason_options(image_type),
-            key=f"{form_id}_choices_{i}",
+            key=kp + "choices",
         )
         reason_choices_joined = " / ".join(reason_choices)
 
-    reason_free = st.text_input("判定理由（自由記述）", key=f"{form_id}_free_{i}", placeholder="例：ピッチが5/7ではないため")
+    reason_free = st.text_input("判定理由（自由記述）", key=kp + "free", placeholder="例：ピッチが5/7ではないため")
 
     learn_no_reason = ""
     if learn_yn == "No":
-        learn_no_reason = st.selectbox("学習No理由（必須）", LEARN_NO_REASONS, key=f"{form_id}_no_reason_{i}")
+        learn_no_reason = st.selectbox("学習No理由（必須）", LEARN_NO_REASONS, key=kp + "no_reason")
         if "その他" in learn_no_reason:
             learn_no_reason += "：" + (reason_free or "（自由記述に補足してください）")
 
-    images_payload.append({
-        "uploaded": uploaded,
+    st.divider()
+
+    # フラグメント再実行時は返り値は使われない（保存はフルrerunで行われ、
+    # そのときに各ウィジェットのsession_state値から組み直される）。
+    # バイト列はセッションキャッシュの参照をそのまま持たせ、保存側が
+    # ウィジェットへ触り直さなくて済むようにする（getvalue()の再コピーもなし）
+    return {
+        "bytes": file_bytes,
+        "mimetype": mimetype,
+        "filename": uploaded.name,
         "image_type": image_type,
         "judge": judge,
         "reason_choices": reason_choices_joined,
         "reason_free": reason_free,
         "learn_yn": learn_yn,
         "learn_no_reason": learn_no_reason,
-    })
+    }
 
-    st.divider()
+
+for i, uploaded in enumerate(uploaded_files):
+    images_payload.append(render_image_block(i, uploaded))
 
 # ★総合判定：写真2枚以上で表示（3→2）
+# 総合判定と保存ボタンはst.formにまとめ、入力のたびにスクリプト全体が
+# rerunされないようにする（Submitまでrerunは走らない）。
+# 写真ごとのウィジェットは画像タイプで理由の選択肢が変わるためform化できない。
 overall = None
-if int(img_count) >= 2:
-    st.subheader("総合判定（写真2枚以上のとき）")
-    oc1, oc2, oc3 = st.columns([1, 2, 1])
-    with oc1:
-        overall_judge = st.selectbox("総合判定", ["基準内", "基準外", "判断つかず"], key=f"{form_id}_overall_j")
-    with oc2:
-        overall_reason_choices = st.multiselect(
-            "総合理由（選択肢・複数OK）",
-            options=[
-                "馬車タグが基準内のため総合は基準内寄り",
-                "最重要ポイント（馬車タグ）が基準外のため総合は基準外寄り",
-                "情報不足のため総合判断つかず",
-                "複合的に判断（基準内要素が優勢）",
-                "複合的に判断（基準外要素が優勢）",
-            ],
-            key=f"{form_id}_overall_choices",
+with st.form(key=f"{form_id}_entry", clear_on_submit=False):
+    if img_count >= 2:
+        st.subheader("総合判定（写真2枚以上のとき）")
+        oc1, oc2, oc3 = st.columns([1, 2, 1])
+        with oc1:
+            overall_judge = st.selectbox("総合判定", ["基準内", "基準外", "判断つかず"], key=f"{form_id}_overall_j")
+        with oc2:
+            overall_reason_choices = st.multiselect(
+                "総合理由（選択肢・複数OK）",
+                options=OVERALL_REASON_CHOICES,
+                key=f"{form_id}_overall_choices",
+            )
+        with oc3:
+            overall_learn_yn = st.radio("総合 学習", ["Yes", "No"], horizontal=True, key=f"{form_id}_overall_learn")
+
+        overall_reason_free = st.text_input("総合理由（自由記述）", key=f"{form_id}_overall_free", placeholder="例：馬車タグが基準内で、他は軽微のため")
+        # form内ではYes/No切替でrerunが走らないため、No理由は常に表示しておき
+        # 保存時にNoのときだけ値を採用する
+        overall_no_reason_sel = st.selectbox(
+            "総合 学習No理由（学習Noのとき必須）", LEARN_NO_REASONS, key=f"{form_id}_overall_no_reason"
         )
-    with oc3:
-        overall_learn_yn = st.radio("総合 学習", ["Yes", "No"], horizontal=True, key=f"{form_id}_overall_learn")
-
-    overall_reason_free = st.text_input("総合理由（自由記述）", key=f"{form_id}_overall_free", placeholder="例：馬車タグが基準内で、他は軽微のため")
-    overall_learn_no_reason = ""
-    if overall_learn_yn == "No":
-        overall_learn_no_reason = st.selectbox("総合 学習No理由（必須）", LEARN_NO_REASONS, key=f"{form_id}_overall_no_reason")
-
-    overall = {
-        "overall_judge": overall_judge,
-        "overall_reason_choices": " / ".join(overall_reason_choices),
-        "overall_reason_free": overall_reason_free,
-        "overall_learn_yn": overall_learn_yn,
-        "overall_learn_no_reason": overall_learn_no_reason,
-    }
+        overall_learn_no_reason = overall_no_reason_sel if overall_learn_yn == "No" else ""
+
+        overall = {
+            "overall_judge": overall_judge,
+            "overall_reason_choices": " / ".join(overall_reason_choices),
+            "overall_reason_free": overall_reason_free,
+            "overall_learn_yn": overall_learn_yn,
+            "overall_learn_no_reason": overall_learn_no_reason,
+        }
+
+    submitted = st.form_submit_button("保存（Drive + Sheets）", type="primary")
 
 st.divider()
 
-if st.button("保存（Drive + Sheets）", type="primary", key=f"{form_id}_save"):
+if submitted:
+    # 前ケースの保存が走っている間の再送信を弾く。
+    # 弾かないと _do_save がもう1本スケジュールされて行が二重登録され、
+    # save_fut の上書きで先行分の例外も握り潰されてしまう。
+    in_flight = st.session_state.get("save_fut")
+    if in_flight is not None and not in_flight.done():
+        st.warning("前の保存がまだ完了していません。完了を待ってからもう一度保存してください。")
+        st.stop()
+
     judge_person_val = judge_person.strip()
     if not judge_person_val:
         st.error("判定者（判定士名）を入力してください。")
         st.stop()
 
-    for idx, p in enumerate(images_payload):
-        if p["uploaded"] is None:
-            st.error(f"写真{idx+1}の画像が未選択です。")
-            st.stop()
+    if not images_payload:
+        st.error("写真を1枚以上アップロードしてください。")
+        st.stop()
+
+    # タイプの選択肢は常に全タイプを出しているので（render_image_block参照）、
+    # 重複と排他はここで確実に弾く
+    types = [p["image_type"] for p in images_payload]
+    if len(set(types)) != len(types):
+        st.error("画像タイプが重複しています。各写真の画像タイプを見直してください。")
+        st.stop()
+
+    # ★双方向排他：IDEALとYKKは共存しない
+    if "IDEAL" in types and "YKK" in types:
+        st.error("IDEALとYKKは同一ケースに登録できません。どちらか一方にしてください。")
+        st.stop()
 
     spreadsheet_id = st.secrets["app"]["spreadsheet_id"]
     drive_root_folder_id = st.secrets["app"]["drive_root_folder_id"]
     weight_version = st.secrets["app"].get("weight_version", "COACH_v1.0")
 
-    gc, drive = get_clients()
-    ws_cases, ws_images = open_worksheets(gc, spreadsheet_id)
-
-    case_id = datetime.now().strftime("%Y%m%d_%H%M%S") + "_" + uuid.uuid4().hex[:8]
-    created_at = now_str()
-    case_folder_id = ensure_folder(drive, case_id, drive_root_folder_id)
-
-    for p in images_payload:
-        up = p["uploaded"]
-        file_bytes = up.getvalue()
-        filename = f"{p['image_type']}_{up.name}"
-        mimetype = up.type or "image/jpeg"
-        file_id, view_url = upload_image_to_drive(drive, case_folder_id, filename, file_bytes, mimetype)
+    sh, ws_cases, ws_images = open_worksheets(spreadsheet_id)
 
-        ws_images.append_row([
-            case_id, p["image_type"], file_id, view_url,
-            p["judge"], p["reason_choices"], p["reason_free"],
-            p["learn_yn"], p["learn_no_reason"], created_at
-        ])
+    # case_idとcreated_atで時刻がズレないよう、現在時刻は1回だけ取る
+    now = datetime.now()
+    case_id = now.strftime("%Y%m%d_%H%M%S") + "_" + uuid.uuid4().hex[:8]
+    created_at = now.strftime("%Y-%m-%d %H:%M:%S")
 
     if overall is None:
-        ws_cases.append_row([
+        case_row = [
             case_id, "COACH", item, judge_person_val, st.session_state.get(f"{form_id}_memo", ""),
-            int(img_count), "", "", "", "", "", weight_version, created_at
-        ])
+            img_count, "", "", "", "", "", weight_version, created_at
+        ]
     else:
-        ws_cases.append_row([
+        case_row = [
             case_id, "COACH", item, judge_person_val, st.session_state.get(f"{form_id}_memo", ""),
-            int(img_count),
+            img_count,
             overall["overall_judge"], overall["overall_reason_choices"], overall["overall_reason_free"],
             overall["overall_learn_yn"], overall["overall_learn_no_reason"],
             weight_version, created_at
-        ])
-
-    st.session_state["saved"] = True
-    st.session_state["last_case_id"] = case_id
-    st.session_state["show_saved_banner"] = True
+        ]
+
+    # 重いI/O（Driveアップロード＋Sheets追記）はバックグラウンドに投げ、
+    # UIはすぐ次の操作を受け付けられるようにする。
+    # 進捗はsave_futを見てrerunごとに描画する
+    # 同一バイト列の再アップロードをセッション内で弾く
+    # （保存やり直しや、同じ参考写真を複数ケースに使うときに効く）。
+    # Imagesシートへの行はケースごとの記録なのでヒット時も通常どおり追記する
+    upload_cache = st.session_state.setdefault("upload_cache", {})
+
+    fut = save_executor().submit(
+        _do_save,
+        get_credentials(),
+        upload_executor(),
+        upload_cache,
+        drive_root_folder_id,
+        case_id,
+        created_at,
+        images_payload,
+        sh,
+        ws_images.id,
+        ws_cases.id,
+        case_row,
+    )
+    st.session_state["save_fut"] = fut
+    st.session_state["save_case_id"] = case_id
+    st.rerun()
 
 st.divider()
+
+# バックグラウンド保存の進捗／結果の反映
+save_fut = st.session_state.get("save_fut")
+if save_fut is not None:
+    if not save_fut.done():
+        st.info("保存中…（Drive/Sheetsへ送信しています。画面はそのまま操作できます）")
+        # 押下によるrerunでdone()を見直すだけなのでon_click等は不要
+        st.button("保存状態を更新", key=f"{form_id}_refresh_save")
+    elif save_fut.exception() is not None:
+        st.session_state.pop("save_fut", None)
+        st.session_state.pop("save_case_id", None)
+        st.error(f"保存に失敗しました：{save_fut.exception()}　もう一度「保存」を押してください。")
+    else:
+        st.session_state.pop("save_fut", None)
+        st.session_state["saved"] = True
+        st.session_state["last_case_id"] = st.session_state.pop("save_case_id", "")
+        st.session_state["show_saved_banner"] = True
+
 if st.session_state.get("show_saved_banner"):
     st.success(f"保存しました！ case_id = {st.session_state.get('last_case_id')}")
     if st.button("次のアイテムに進む（判定者だけ残してクリア）", type="primary", key=f"{form_id}_next_bottom"):